@@ -5,18 +5,331 @@ from pptx.util import Inches, Pt
 from pptx.enum.text import MSO_ANCHOR, MSO_AUTO_SIZE
 from pptx.enum.chart import XL_CHART_TYPE
 from pptx.chart.data import CategoryChartData
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn
+from pptx.oxml.xmlchemy import OxmlElement
 import io
+import os
+import re
 import uuid
 import json
+import hashlib
+import tempfile
+import threading
+import time
+import zipfile
+import orjson
 import requests
+from PIL import Image, ImageOps
+from dataclasses import dataclass
+from types import MappingProxyType
+from xml.sax.saxutils import escape as xml_escape
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# .pptx files are ZIP archives and DEFLATE dominates prs.save. python-pptx
+# writes them through the stdlib zipfile module, so point that module at
+# zlib-ng's SIMD-accelerated implementation when it is installed.
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    pass
+else:
+    zipfile.zlib = zlib_ng
+    zipfile.crc32 = zlib_ng.crc32
 
 app = Flask(__name__)
 
 # Enable CORS for all origins
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-# Dictionary to store generated files and their IDs
-generated_files = {}
+def remove_generated_file(future):
+    """Delete the temp file a save future wrote, once it has finished."""
+    def unlink(done):
+        # A cancelled or failed save left no file. gevent's futures raise from
+        # exception() rather than returning the error, so only ask for result();
+        # this may run inside cache eviction and must never raise.
+        try:
+            os.unlink(done.result())
+        except Exception:
+            return
+    future.add_done_callback(unlink)
+
+class GeneratedFileCache(TTLCache):
+    """TTL/LRU cache of save futures that deletes each file as it is evicted."""
+
+    def popitem(self):
+        key, future = super().popitem()
+        remove_generated_file(future)
+        return key, future
+
+    def expire(self, time=None):
+        # Returns the expired (key, value) pairs since cachetools 5.5
+        expired = super().expire(time)
+        for _key, future in expired:
+            remove_generated_file(future)
+        return expired
+
+# Generated files by ID. Values are futures resolving to the path of the
+# saved .pptx; files are kept on disk for an hour, at most 1024 at a time.
+generated_files = GeneratedFileCache(maxsize=1024, ttl=3600)
+generated_files_lock = threading.Lock()
+
+# Worker pool for CPU-bound work kept off the request path: saving decks and
+# fitting images. Under a gevent worker (threading monkey-patched) it must
+# run on native threads rather than greenlets that would stall the whole
+# hub, and anything it shares needs a native lock, not a gevent one.
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+if monkey is not None and monkey.is_module_patched('threading'):
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+    cpu_executor = NativeThreadPoolExecutor(max_workers=4)
+    native_lock = monkey.get_original('_thread', 'allocate_lock')
+else:
+    cpu_executor = ThreadPoolExecutor(max_workers=4)
+    native_lock = threading.Lock
+
+def serialize_presentation(prs):
+    """Save a presentation to a temp file and return its path."""
+    fd, path = tempfile.mkstemp(prefix='presentation_', suffix='.pptx')
+    try:
+        with os.fdopen(fd, 'wb') as pptx_file:
+            prs.save(pptx_file)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+# Unit conversions are repeated for the same handful of values on every
+# slide, so memoize them
+@lru_cache(maxsize=256)
+def inches(value):
+    return Inches(value)
+
+@lru_cache(maxsize=256)
+def pt(value):
+    return Pt(value)
+
+# Default shape positions in inches, used for any key a slide leaves out
+DEFAULT_IMAGE_POSITION = MappingProxyType({'left': 1, 'top': 1, 'width': 3, 'height': 2})
+DEFAULT_TABLE_POSITION = MappingProxyType({'left': 1, 'top': 3, 'width': 8, 'height': 2})
+DEFAULT_CHART_POSITION = MappingProxyType({'left': 1, 'top': 3, 'width': 6, 'height': 4})
+
+def shape_position(position, defaults):
+    """Return (left, top, width, height) for a shape, filling gaps from defaults."""
+    return tuple(
+        inches(position.get(key, defaults[key])) for key in ('left', 'top', 'width', 'height')
+    )
+
+# Worker pool shared by all requests for fetching slide images concurrently
+IMAGE_FETCH_WORKERS = 16
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS)
+
+# One keep-alive session for the whole process so image hosts are not
+# re-handshaked (TCP + TLS) for every picture
+http_session = requests.Session()
+http_session.headers.update({"User-Agent": f"Powerpoint_Generator_bot/1.0 requests/{requests.__version__}"})
+for scheme in ('https://', 'http://'):
+    http_session.mount(scheme, HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    ))
+
+# (connect, read) timeout for image requests, and how long a deck waits in
+# total for its images before giving up on the ones still outstanding
+IMAGE_FETCH_TIMEOUT = (5, 10)
+IMAGE_WAIT_TIMEOUT = 30
+
+# Largest image body accepted, and the total bytes of downloaded images
+# kept between requests
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+@cached(LRUCache(maxsize=IMAGE_CACHE_BYTES, getsizeof=len), lock=threading.Lock())
+def fetch_image(url):
+    """Download an image, returning its bytes. Results are cached by URL."""
+    with http_session.get(url, stream=True, timeout=IMAGE_FETCH_TIMEOUT) as response:
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+            raise ValueError(f'Image larger than {MAX_IMAGE_BYTES} bytes: {url}')
+        # Copy the (decoded) body in chunks rather than materializing
+        # response.content, stopping once it passes the size limit
+        image_stream = io.BytesIO()
+        for chunk in response.iter_content(64 * 1024):
+            image_stream.write(chunk)
+            if image_stream.tell() > MAX_IMAGE_BYTES:
+                raise ValueError(f'Image larger than {MAX_IMAGE_BYTES} bytes: {url}')
+    return image_stream.getvalue()
+
+# Resolution images are reduced to for their size on the slide. A 10 inch
+# wide slide at 1920 pixels is 192 DPI, so full-screen playback stays sharp.
+IMAGE_DPI = 192
+
+# EXIF orientations that rotate the image by 90 degrees one way or the other
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION = 0x0112
+
+# Total bytes of fitted images kept, keyed by image content and on-slide size
+FITTED_IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+def fit_image(image_bytes, width, height):
+    """Return the image bytes, downscaled if larger than the image is displayed.
+
+    The picture is stretched to width x height on the slide, so the image is
+    only shrunk while both of its sides still cover that box at IMAGE_DPI.
+    JPEGs stay JPEG and other formats are re-encoded as PNG to keep
+    transparency, with EXIF rotation applied and the ICC profile kept.
+    Animated images and anything Pillow cannot handle are passed through
+    untouched.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as im:
+            if getattr(im, 'is_animated', False):
+                return image_bytes
+
+            # Size the image as it is displayed, after any EXIF rotation
+            transposed = im.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS
+            display_w, display_h = (im.height, im.width) if transposed else im.size
+            target_w = max(1, round(width.inches * IMAGE_DPI))
+            target_h = max(1, round(height.inches * IMAGE_DPI))
+            scale = max(target_w / display_w, target_h / display_h)
+            if scale >= 1:
+                return image_bytes
+
+            size = (max(1, round(display_w * scale)), max(1, round(display_h * scale)))
+            image_format = 'JPEG' if im.format == 'JPEG' else 'PNG'
+            icc_profile = im.info.get('icc_profile')
+            # Let the JPEG decoder skip detail we are about to throw away
+            im.draft(im.mode, size[::-1] if transposed else size)
+            image = ImageOps.exif_transpose(im)
+            # Pillow resizes palette and bilevel images with NEAREST
+            if image.mode in ('P', 'PA'):
+                image = image.convert('RGBA')
+            elif image.mode == '1':
+                image = image.convert('L')
+            resized = image.resize(size, Image.LANCZOS)
+
+            out = io.BytesIO()
+            if image_format == 'JPEG':
+                resized.save(out, 'JPEG', quality=85, optimize=True, icc_profile=icc_profile)
+            else:
+                resized.save(out, 'PNG', optimize=True, icc_profile=icc_profile)
+    except Exception:
+        return image_bytes
+    return out.getvalue()
+
+@cached(
+    LRUCache(maxsize=FITTED_IMAGE_CACHE_BYTES, getsizeof=len),
+    key=lambda image_bytes, width, height: hashkey(
+        hashlib.blake2b(image_bytes, digest_size=16).digest(), width, height
+    ),
+    lock=native_lock()
+)
+def fitted_image(image_bytes, width, height):
+    """fit_image, memoized per image content and on-slide size so repeated logos are fitted once."""
+    return fit_image(image_bytes, width, height)
+
+def set_default_font_size(text_frame, size):
+    """Set the font size for all paragraphs of a text frame in one place.
+
+    The size is written to the shape's own list style (a:lstStyle/a:lvl1pPr)
+    so every paragraph inherits it, instead of touching each paragraph.
+    """
+    # a:defRPr is a python-pptx oxml class, so assigning sz applies the same
+    # ST_TextFontSize range check as font.size; do it before touching the tree
+    defRPr = OxmlElement('a:defRPr')
+    defRPr.sz = size.centipoints
+    lvl1pPr = parse_xml('<a:lvl1pPr %s/>' % nsdecls('a'))
+    lvl1pPr.append(defRPr)
+
+    txBody = text_frame._txBody
+    lstStyle = txBody.find(qn('a:lstStyle'))
+    if lstStyle is None:
+        lstStyle = parse_xml('<a:lstStyle %s/>' % nsdecls('a'))
+        txBody.bodyPr.addnext(lstStyle)
+    for old_lvl1pPr in lstStyle.findall(qn('a:lvl1pPr')):
+        lstStyle.remove(old_lvl1pPr)
+    # lvl1pPr follows an optional defPPr in the schema sequence
+    defPPr = lstStyle.find(qn('a:defPPr'))
+    if defPPr is not None:
+        defPPr.addnext(lvl1pPr)
+    else:
+        lstStyle.insert(0, lvl1pPr)
+
+# Control characters are not allowed in XML; python-pptx writes them as _xHHHH_
+CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B-\x1F]')
+
+def cell_xml(value):
+    """Return the a:tc XML for a table cell, matching python-pptx's cell.text.
+
+    Each line of the text becomes a paragraph and vertical tabs become line
+    breaks.
+    """
+    paragraphs = []
+    for line in str(value).split('\n'):
+        parts = []
+        for idx, run_text in enumerate(line.split('\v')):
+            if idx > 0:
+                parts.append('<a:br/>')
+            if run_text:
+                run_text = CONTROL_CHARS.sub(lambda m: '_x%04X_' % ord(m.group()), run_text)
+                parts.append('<a:r><a:t>%s</a:t></a:r>' % xml_escape(run_text))
+        paragraphs.append('<a:p>%s</a:p>' % ''.join(parts) if parts else '<a:p/>')
+    return '<a:tc><a:txBody><a:bodyPr/><a:lstStyle/>%s</a:txBody><a:tcPr/></a:tc>' % ''.join(paragraphs)
+
+def populate_table(table, table_data):
+    """Fill a freshly added table with table_data in a single XML parse.
+
+    Assigning cell.text builds each cell's runs through lxml one at a time;
+    instead the rows are rendered as one XML string and swapped in whole.
+    Rows shorter than the table are padded with empty cells and extra
+    columns are dropped.
+    """
+    tbl = table._tbl
+    cols = len(tbl.tblGrid.gridCol_lst)
+    old_rows = tbl.tr_lst
+    rows_xml = []
+    for tr, row_data in zip(old_rows, table_data):
+        row_data = list(row_data)[:cols]
+        cells = ''.join(cell_xml(cell_data) for cell_data in row_data)
+        cells += cell_xml('') * (cols - len(row_data))
+        rows_xml.append('<a:tr h="%d">%s</a:tr>' % (tr.h, cells))
+    new_tbl = parse_xml('<a:tbl %s>%s</a:tbl>' % (nsdecls('a'), ''.join(rows_xml)))
+    for tr in old_rows:
+        tbl.remove(tr)
+    tbl.extend(new_tbl.tr_lst)
+
+@dataclass(slots=True)
+class SlideData:
+    """One slide from the request, validated once with its content flags precomputed."""
+    fields: dict
+    has_body: bool
+    has_images: bool
+    has_table: bool
+    has_chart: bool
+
+    @classmethod
+    def from_json(cls, fields):
+        if not isinstance(fields, dict):
+            raise ValueError('Each slide must be an object.')
+        # Bad entries inside the list are logged and skipped per image
+        if not isinstance(fields.get('images', []), list):
+            raise ValueError("Slide 'images' must be a list.")
+        return cls(
+            fields=fields,
+            has_body='body' in fields,
+            has_images='images' in fields,
+            has_table='table_data' in fields,
+            has_chart='chart_data' in fields
+        )
 
 @app.route('/generate_pptx', methods=['POST', 'OPTIONS'])
 def generate_pptx():
@@ -24,17 +337,19 @@ def generate_pptx():
         return jsonify({'status': 'OK'}), 200  # Respond to preflight request
 
     try:
-        # Get the raw request body as a string
-        request_body = request.get_data(as_text=True)
-
-        # Parse the request body as JSON
+        # Parse the raw request body as JSON. orjson only accepts strict UTF-8
+        # JSON, so fall back to json on the decoded text, which also takes
+        # NaN/Infinity and replaces invalid UTF-8 as before
         try:
-            data = json.loads(request_body)
-        except json.JSONDecodeError as e:
-            return jsonify({'error': f'Invalid JSON in request body: {e}'}), 400
+            data = orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            try:
+                data = json.loads(request.get_data(as_text=True))
+            except json.JSONDecodeError as e:
+                return jsonify({'error': f'Invalid JSON in request body: {e}'}), 400
 
         # Ensure the 'slides' key is present
-        if 'slides' not in data:
+        if not isinstance(data, dict) or 'slides' not in data:
             return jsonify({'error': 'Invalid input. Must provide slides.'}), 400
 
         # If slides is a dictionary (single slide), convert to list
@@ -43,18 +358,40 @@ def generate_pptx():
         else:
             slides = data['slides']
 
+        # Validate every slide before doing any work
+        if not isinstance(slides, list):
+            return jsonify({'error': 'Invalid input. slides must be a list or an object.'}), 400
+        try:
+            slides = [SlideData.from_json(slide_data) for slide_data in slides]
+        except ValueError as e:
+            return jsonify({'error': f'Invalid input. {e}'}), 400
+
         # Create a new presentation
         prs = Presentation()
 
+        # Start every image download up front so they overlap with each other
+        # and with slide construction. Repeated URLs share a single download.
+        image_futures = {}
+        for slide_info in slides:
+            for img_data in slide_info.fields.get('images', []):
+                url = img_data.get('url') if isinstance(img_data, dict) else None
+                if isinstance(url, str) and url not in image_futures:
+                    image_futures[url] = image_executor.submit(fetch_image, url)
+        image_deadline = time.monotonic() + IMAGE_WAIT_TIMEOUT
+
+        # Look up the layouts once rather than per slide
+        layout_content = prs.slide_layouts[5]  # Layout with content
+        layout_title = prs.slide_layouts[1]  # Title and content layout
+
         # Process each slide
-        for slide_data in slides:
+        for slide_info in slides:
+            slide_data = slide_info.fields
+
             # Choose slide layout based on content
-            if 'chart_data' in slide_data:
-                slide_layout = prs.slide_layouts[5]  # Layout with content
-            elif 'table_data' in slide_data:
-                slide_layout = prs.slide_layouts[5]  # Layout with content
+            if slide_info.has_chart or slide_info.has_table:
+                slide_layout = layout_content
             else:
-                slide_layout = prs.slide_layouts[1]  # Title and content layout
+                slide_layout = layout_title
 
             # Add slide
             slide = prs.slides.add_slide(slide_layout)
@@ -64,69 +401,62 @@ def generate_pptx():
             if title_shape:
                 title_shape.text = slide_data.get('title', 'Untitled Slide')
                 title_font_size = slide_data.get('title_font_size', 18)
-                title_shape.text_frame.paragraphs[0].font.size = Pt(title_font_size)
+                title_shape.text_frame.paragraphs[0].font.size = pt(title_font_size)
 
             # Body Text
-            if 'body' in slide_data:
-                # Find the body placeholder
-                body_placeholder = None
-                for shape in slide.placeholders:
-                    if shape.has_text_frame and shape.text_frame.text == "":
-                        body_placeholder = shape
-                        break
+            if slide_info.has_body:
+                # The body placeholder is idx 1 on the title-and-content layout;
+                # the title-only layout used for charts and tables has none
+                try:
+                    body_placeholder = slide.placeholders[1]
+                except KeyError:
+                    body_placeholder = None
 
                 if body_placeholder:
                     text_frame = body_placeholder.text_frame
                     text_frame.text = slide_data['body']  # Set the body text
                     body_font_size = slide_data.get('body_font_size', 12)
-                    text_frame.paragraphs[0].font.size = Pt(body_font_size)
+                    set_default_font_size(text_frame, pt(body_font_size))
                     text_frame.auto_size = MSO_AUTO_SIZE.TEXT_TO_FIT_SHAPE
                     text_frame.vertical_anchor = MSO_ANCHOR.TOP
 
             # Images
-            if 'images' in slide_data:
+            if slide_info.has_images:
                 for img_data in slide_data['images']:
                     try:
-                        headers = {"User-Agent": "Powerpoint_Generator_bot/1.0 requests/{requests.__version__}"}
-                        response = requests.get(img_data['url'], headers=headers, stream=True)
-                        response.raise_for_status()
-                        image_stream = io.BytesIO(response.content)
+                        image_bytes = image_futures[img_data['url']].result(
+                            timeout=max(0, image_deadline - time.monotonic())
+                        )
 
                         # Add image with specified or default positioning
-                        left = Inches(img_data.get('left', 1))
-                        top = Inches(img_data.get('top', 1))
-                        width = Inches(img_data.get('width', 3))
-                        height = Inches(img_data.get('height', 2))
+                        left, top, width, height = shape_position(img_data, DEFAULT_IMAGE_POSITION)
 
+                        fitted = cpu_executor.submit(fitted_image, image_bytes, width, height).result()
+                        image_stream = io.BytesIO(fitted)
                         slide.shapes.add_picture(image_stream, left, top, width, height)
                     except Exception as e:
                         print(f"Error adding image: {e}")
 
             # Tables
-            if 'table_data' in slide_data:
+            if slide_info.has_table:
                 table_data = slide_data['table_data']
                 rows = len(table_data)
                 cols = len(table_data[0]) if table_data else 0
 
                 # Default positioning
-                table_position = slide_data.get('table_position', {})
-                left = Inches(table_position.get('left', 1))
-                top = Inches(table_position.get('top', 3))
-                width = Inches(table_position.get('width', 8))
-                height = Inches(table_position.get('height', 2))
+                left, top, width, height = shape_position(
+                    slide_data.get('table_position', {}), DEFAULT_TABLE_POSITION
+                )
 
                 # Add table
                 table_shape = slide.shapes.add_table(rows, cols, left, top, width, height)
                 table = table_shape.table
 
                 # Populate table
-                for row_idx, row_data in enumerate(table_data):
-                    for col_idx, cell_data in enumerate(row_data):
-                        cell = table.cell(row_idx, col_idx)
-                        cell.text = str(cell_data)
+                populate_table(table, table_data)
 
             # Charts
-            if 'chart_data' in slide_data:
+            if slide_info.has_chart:
                 chart_data = slide_data['chart_data']
                 try:
                     # Prepare chart data
@@ -140,11 +470,9 @@ def generate_pptx():
                         )
 
                     # Default chart positioning
-                    chart_position = chart_data.get('chart_position', {})
-                    x = Inches(chart_position.get('left', 1))
-                    y = Inches(chart_position.get('top', 3))
-                    cx = Inches(chart_position.get('width', 6))
-                    cy = Inches(chart_position.get('height', 4))
+                    x, y, cx, cy = shape_position(
+                        chart_data.get('chart_position', {}), DEFAULT_CHART_POSITION
+                    )
 
                     # Add chart
                     chart_type = getattr(XL_CHART_TYPE, chart_data.get('type', 'COLUMN_CLUSTERED'))
@@ -158,19 +486,16 @@ def generate_pptx():
                         chart.chart_title.has_text_frame = True
                         chart.chart_title.text_frame.text = chart_data['title']
                         chart_title_font_size = chart_data.get('title_font_size', 14)
-                        chart.chart_title.text_frame.paragraphs[0].font.size = Pt(chart_title_font_size)
+                        chart.chart_title.text_frame.paragraphs[0].font.size = pt(chart_title_font_size)
 
                 except Exception as e:
                     print(f"Error adding chart: {e}")
 
-        # Save the presentation to a buffer
-        pptx_buffer = io.BytesIO()
-        prs.save(pptx_buffer)
-        pptx_buffer.seek(0)
-
-        # Generate a unique ID for the file
+        # Save the presentation in the background; the download waits for it
         file_id = str(uuid.uuid4())
-        generated_files[file_id] = pptx_buffer
+        future = cpu_executor.submit(serialize_presentation, prs)
+        with generated_files_lock:
+            generated_files[file_id] = future
 
         # Generate the download link
         download_link = url_for('download_file', file_id=file_id, _external=True)
@@ -182,15 +507,29 @@ def generate_pptx():
 
 @app.route('/download/<file_id>')
 def download_file(file_id):
-    if file_id in generated_files:
-        pptx_buffer = generated_files[file_id]
+    with generated_files_lock:
+        future = generated_files.get(file_id)
+    if future is None:
+        return "File not found", 404
+
+    try:
+        pptx_path = future.result()
+    except Exception as e:
+        return jsonify({'error': f'Error saving presentation: {e}'}), 500
+
+    try:
+        # Sending by path lets the WSGI file wrapper hand the file to the
+        # kernel (gunicorn uses sendfile(2)); conditional enables range and
+        # If-None-Match requests
         return send_file(
-            pptx_buffer,
+            pptx_path,
             mimetype='application/vnd.openxmlformats-officedocument.presentationml.presentation',
             download_name='generated_presentation.pptx',
-            as_attachment=True
+            as_attachment=True,
+            conditional=True
         )
-    else:
+    except FileNotFoundError:
+        # Evicted between the lookup and opening the file
         return "File not found", 404
 
 if __name__ == '__main__':
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a child process so gevent's monkey-patching, which is how the
+# Procfile serves the app, does not leak into the rest of the test session.
+EVICT_FAILED_SAVE = textwrap.dedent("""
+    from gevent import monkey
+    monkey.patch_all()
+
+    import os
+    from pptx import Presentation
+    import generate_powerpoint as gp
+
+    assert type(gp.cpu_executor).__module__ == 'gevent.threadpool'
+
+    def failing_save():
+        raise OSError('disk full')
+
+    cache = gp.GeneratedFileCache(maxsize=1, ttl=3600)
+    failed = gp.cpu_executor.submit(failing_save)
+    try:
+        failed.result()
+    except OSError:
+        pass
+    cache['failed'] = failed
+
+    # Evicting the failed save must not raise into the unrelated insert
+    saved = gp.cpu_executor.submit(gp.serialize_presentation, Presentation())
+    path = saved.result()
+    cache['saved'] = saved
+    assert 'failed' not in cache and os.path.exists(path)
+
+    # Expiry still unlinks every file after a failed entry
+    cache = gp.GeneratedFileCache(maxsize=2, ttl=3600)
+    cache['failed'] = failed
+    saved = gp.cpu_executor.submit(gp.serialize_presentation, Presentation())
+    path = saved.result()
+    cache['saved'] = saved
+    cache.expire(cache.timer() + 7200)
+    assert len(cache) == 0 and not os.path.exists(path)
+    print('ok')
+""")
+
+
+def test_evicting_failed_save_under_gevent():
+    pytest.importorskip('gevent')
+    result = subprocess.run(
+        [sys.executable, '-c', EVICT_FAILED_SAVE],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == 'ok'